@@ -3,16 +3,16 @@
 HAOS Kiosk: Idle/first-touch swallow daemon (overlay method)
 
 Goal:
-  After SCREEN_TIMEOUT seconds of *user inactivity*, blank the display (xset dpms force off)
+  After SCREEN_TIMEOUT seconds of *user inactivity*, blank the display (DPMS force off)
   and install a fullscreen overlay window that captures the *first* touch/click.
-  That first interaction wakes the screen (xset dpms force on) but is swallowed so
-  it does NOT reach the browser/dashboard. Overlay is then removed and normal
+  That first interaction wakes the screen (DPMS force on) but is swallowed so
+  it does NOT reach the browser/dashboard. Overlay is then unmapped and normal
   interaction resumes.
 
 Design (no periodic polling):
-  We emulate an event-driven wait using select() on the X connection with a timeout
-  equal to remaining idle interval. If no events arrive before timeout -> blank.
-  While blanked, we block in select() until an input event arrives on the overlay.
+  We block in epoll on the X connection plus a timerfd armed for the remaining idle
+  interval. When the timer fires, idle is re-checked and we either blank or re-arm.
+  While blanked, the timer is disarmed and we block until an input event arrives on the overlay.
 
 Assumptions / Simplifications:
   - SCREEN_TIMEOUT > 0 (caller ensures daemon not started if 0 desired behavior).
@@ -24,7 +24,7 @@ Assumptions / Simplifications:
 Edge Cases:
   - Rapid double tap: Only first press swallowed; second proceeds.
   - Long press: Entire first button press+release swallowed.
-  - Multitouch generating multiple ButtonPress events rapidly: We treat first event as swallow trigger and immediately wake; subsequent events after overlay removal will reach browser (acceptable compromise).
+  - Multitouch generating multiple ButtonPress events rapidly: We treat first event as swallow trigger and immediately wake; subsequent events after the overlay is unmapped will reach browser (acceptable compromise).
 
 Failures gracefully logged to stdout.
 """
@@ -32,7 +32,7 @@ import os
 import sys
 import time
 import select
-import subprocess
+import ctypes
 import logging
 from typing import Optional
 
@@ -44,8 +44,7 @@ logging.basicConfig(stream=sys.stdout, level=LOG_LEVEL,
 try:
     from Xlib import X, display
     from Xlib.protocol import request
-    from Xlib.ext import screensaver  # Added for accurate idle detection
-    from Xlib.ext import xinput  # For Raw (XI2) events fallback
+    from Xlib.ext import dpms  # DPMS requests sent over our own connection (no xset fork)
 except Exception as e:  # pragma: no cover
     logging.error(f"python-xlib not available or failed to import: {e}")
     sys.exit(1)
@@ -67,20 +66,91 @@ if not SWALLOW_FIRST_TOUCH:
     logging.info("SWALLOW_FIRST_TOUCH disabled; exiting")
     sys.exit(0)
 
+# -------------- timerfd (via libc; not exposed by the Python 3.12 stdlib) --------------
+CLOCK_MONOTONIC = 1
+TFD_NONBLOCK = os.O_NONBLOCK
+TFD_CLOEXEC = os.O_CLOEXEC
+
+class _Timespec(ctypes.Structure):
+    # Layout for the plain (non-time64) libc symbols looked up below
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+class _Itimerspec(ctypes.Structure):
+    _fields_ = [("it_interval", _Timespec), ("it_value", _Timespec)]
+
+class TimerFd:
+    # One-shot CLOCK_MONOTONIC timer whose expiry makes its fd readable
+    _libc = ctypes.CDLL(None, use_errno=True)
+
+    def __init__(self):
+        fd = self._libc.timerfd_create(CLOCK_MONOTONIC, TFD_NONBLOCK | TFD_CLOEXEC)
+        if fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, f"timerfd_create: {os.strerror(err)}")
+        self.fd = fd
+        self.armed = False
+
+    def fileno(self) -> int:
+        return self.fd
+
+    def _settime(self, sec: int, nsec: int):
+        spec = _Itimerspec()
+        spec.it_value.tv_sec = sec
+        spec.it_value.tv_nsec = nsec
+        if self._libc.timerfd_settime(self.fd, 0, ctypes.byref(spec), None) < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, f"timerfd_settime: {os.strerror(err)}")
+
+    def arm(self, seconds: float):
+        sec = int(seconds)
+        nsec = int((seconds - sec) * 1e9)
+        self._settime(sec, nsec or (0 if sec else 1))  # All-zero value would disarm instead
+        self.armed = True
+
+    def consume(self):
+        # Clear readiness after expiry
+        try:
+            os.read(self.fd, 8)
+        except BlockingIOError:
+            pass
+        self.armed = False
+
+    def close(self):
+        os.close(self.fd)
+
+# Input event lookups, built once: event code -> (name, xi2_raw, can_wake). XI2 raw entries are
+# built in IdleSwallowDaemon.__init__ once XI2 raw events are enabled.
+CORE_EVENT_INFO = {
+    X.KeyPress: ('KeyPress', False, True),
+    X.KeyRelease: ('KeyRelease', False, True),
+    X.ButtonPress: ('ButtonPress', False, True),
+    X.ButtonRelease: ('ButtonRelease', False, True),
+    X.MotionNotify: ('MotionNotify', False, True),
+}
+RAW_EVENT_TYPES = ("RawMotion", "RawKeyPress", "RawKeyRelease", "RawButtonPress", "RawButtonRelease",
+                   "RawTouchBegin", "RawTouchUpdate", "RawTouchEnd")
+RAW_WAKE_EVENTS = frozenset(("RawButtonPress", "RawTouchBegin", "RawKeyPress"))
+
 class IdleSwallowDaemon:
     def __init__(self, timeout: int):
         self.timeout = timeout
+        self._debug = LOG_LEVEL == logging.DEBUG  # Fixed at startup; gates all per-event debug formatting
         self.disp = display.Display()
         self.root = self.disp.screen().root
-        # Select root events (fallback path if XScreenSaver extension not present)
-        self.root.change_attributes(event_mask=(X.KeyPressMask | X.KeyReleaseMask |
-                                                X.ButtonPressMask | X.ButtonReleaseMask |
-                                                X.PointerMotionMask | X.StructureNotifyMask))
         self.overlay: Optional[int] = None
+        self.overlay_win = None  # Persistent overlay window object (see _create_overlay)
         self.blanked = False
-        self.last_activity = time.time()  # Fallback only
+        self._last_activity_ns = time.monotonic_ns()  # Fallback only
+        # Register the X connection fd and the blank timer once with epoll (level-triggered)
+        self._x_fd = self.disp.fileno()
+        self._timer = TimerFd()  # Armed for the earliest time the screen can blank
+        self._ep = select.epoll()
+        self._ep.register(self._x_fd, select.EPOLLIN)
+        self._ep.register(self._timer.fileno(), select.EPOLLIN)
         # Detect XScreenSaver extension availability
         try:
+            from Xlib.ext import screensaver  # Added for accurate idle detection
+            self._screensaver = screensaver
             # Query once to confirm availability
             _ = screensaver.query_info(self.disp, self.root).reply()
             self.ss_available = True
@@ -88,10 +158,13 @@ class IdleSwallowDaemon:
         except Exception:
             self.ss_available = False
             logging.info("XScreenSaver extension NOT available; falling back to event-based idle timing")
+        self._select_root_events()
         # Attempt to enable XI2 raw events to improve fallback idle detection
         self.xi2_raw_enabled = False
+        self._raw_info = {}
         if not self.ss_available:
             try:
+                from Xlib.ext import xinput  # For Raw (XI2) events fallback
                 xinput.query_version(self.disp, 2, 3)  # Ensure XI2 available
                 # Build event mask for raw events
                 masks = [xinput.RawMotion, xinput.RawKeyPress, xinput.RawKeyRelease,
@@ -103,166 +176,200 @@ class IdleSwallowDaemon:
                 em = xinput.EventMask(deviceid=xinput.AllDevices, mask=masks)
                 self.disp.xinput_select_events(self.root, [em])
                 self.disp.flush()
+                self._raw_info = {getattr(xinput, name): (name, True, name in RAW_WAKE_EVENTS)
+                                  for name in RAW_EVENT_TYPES if hasattr(xinput, name)}
                 self.xi2_raw_enabled = True
                 logging.info("XI2 raw event monitoring enabled for idle fallback")
             except Exception as e:
                 logging.warning(f"Failed to enable XI2 raw events fallback: {e}")
+        self._classify_event = self._classify_with_xi2 if self.xi2_raw_enabled else self._classify_core
+        self._create_overlay()
 
-    # -------------- Utility Commands --------------
-    def _run(self, cmd: str):
+    def _select_root_events(self):
+        # Input events on the root are only needed for the fallback idle path; with XScreenSaver
+        # the server tracks idle itself, so skip them (no MotionNotify flood while browsing).
+        # The overlay selects its own input events for the wake+swallow path.
+        if self.ss_available:
+            mask = X.StructureNotifyMask
+        else:
+            mask = (X.KeyPressMask | X.KeyReleaseMask |
+                    X.ButtonPressMask | X.ButtonReleaseMask |
+                    X.PointerMotionMask | X.StructureNotifyMask)
+        self.root.change_attributes(event_mask=mask)
+
+    # -------------- DPMS Control --------------
+    def _dpms_force(self, level: int):
+        # Same as 'xset dpms force <level>' (which also enables DPMS first), but reuses our X connection
         try:
-            subprocess.run(cmd, shell=True, check=False, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            self.disp.dpms_enable()
+            self.disp.dpms_force_level(level)
+            self.disp.flush()
         except Exception as e:  # pragma: no cover
-            logging.warning(f"command failed '{cmd}': {e}")
+            logging.warning(f"DPMS force level {level} failed: {e}")
 
     # -------------- Overlay Management --------------
-    def create_overlay(self):
-        if self.overlay is not None:
-            return
+    # The overlay is created once (unmapped) and only mapped/unmapped per blank cycle,
+    # avoiding CreateWindow/DestroyWindow traffic and server-side allocation churn
+    def _create_overlay(self):
         screen = self.disp.screen()
         width = screen.width_in_pixels
         height = screen.height_in_pixels
-        # Create top-level override-redirect window
+        # Create top-level override-redirect InputOnly window: it only has to capture input while
+        # the panel is off, so it has no pixels for the server/compositor to allocate or redraw
         win = self.root.create_window(
             0, 0, width, height, 0,
-            screen.root_depth,
-            X.InputOutput,
+            X.CopyFromParent,  # depth (must be 0 for InputOnly)
+            X.InputOnly,
             X.CopyFromParent,
-            background_pixel=0x000000,  # black (invisible while off anyway)
             override_redirect=True,
             event_mask=(X.ButtonPressMask | X.ButtonReleaseMask | X.PointerMotionMask | X.KeyPressMask | X.KeyReleaseMask)
         )
-        # Raise & map
-        win.map()
-        self.disp.sync()
+        self.disp.flush()
+        self.overlay_win = win
         self.overlay = win.id
-        logging.info(f"Overlay created (id={self.overlay}) and mapped; screen blanked")
+        logging.info(f"Overlay created (id={self.overlay}); mapped only while blanked")
 
-    def destroy_overlay(self):
+    def _destroy_overlay(self):
         if self.overlay is None:
             return
         try:
-            ov = self.disp.create_resource_object('window', self.overlay)
-            ov.unmap()
-            ov.destroy()
-            self.disp.sync()
+            self.overlay_win.destroy()
+            self.disp.flush()
             logging.info(f"Overlay destroyed (id={self.overlay})")
         except Exception as e:  # pragma: no cover
             logging.warning(f"failed destroying overlay: {e}")
         finally:
+            self.overlay_win = None
             self.overlay = None
 
     # -------------- Blank / Wake Logic --------------
     def blank_screen(self):
         if self.blanked:
             return
-        self.create_overlay()
+        # Raise & map overlay (flushed together with the DPMS request below); windows
+        # created or raised since our last cycle would otherwise stay on top of it
+        self.overlay_win.raise_window()
+        self.overlay_win.map()
         # Force DPMS off (panel off)
-        self._run('xset dpms force off')
+        self._dpms_force(dpms.DPMSModeOff)
         self.blanked = True
-        logging.info("Screen blanked (DPMS off)")
+        logging.info("Screen blanked (DPMS off); overlay mapped")
 
     def wake_screen(self):
         if not self.blanked:
             return
-        self._run('xset dpms force on')
+        self._dpms_force(dpms.DPMSModeOn)
         time.sleep(0.05)
-        self.destroy_overlay()
+        self.overlay_win.unmap()
+        self.disp.flush()
         self.blanked = False
         # Reset fallback activity baseline; XScreenSaver idle resets automatically due to input event
-        self.last_activity = time.time()
+        self._last_activity_ns = time.monotonic_ns()
         logging.info("Screen awakened; first touch swallowed")
 
     # -------------- Idle Time --------------
     def get_idle_seconds(self) -> float:
         if self.ss_available:
             try:
-                info = screensaver.query_info(self.disp, self.root).reply()
+                info = self._screensaver.query_info(self.disp, self.root).reply()
                 return info.idle / 1000.0  # ms -> s
             except Exception:
                 # On error, disable extension for rest of session
                 if self.ss_available:
                     logging.warning("XScreenSaver query failed; reverting to fallback")
                 self.ss_available = False
-        # Fallback: derive idle from last_activity maintained by input events we see
-        return max(0.0, time.time() - self.last_activity)
+                self._select_root_events()
+                # Fallback baseline was not maintained while XScreenSaver was in use; start it now
+                self._last_activity_ns = time.monotonic_ns()
+        # Fallback: derive idle from the activity timestamp maintained by input events we see
+        return max(0.0, (time.monotonic_ns() - self._last_activity_ns) * 1e-9)
 
     # -------------- Event Handling --------------
+    # _classify_event is bound in __init__ to one of the two classifiers below so the
+    # common (no XI2) path never pays for the XI2 raw event checks. Each returns
+    # (name, xi2_raw, can_wake) for input events and None for anything else.
+    # Non-waking input is coalesced: a drained batch carries the same information as
+    # its last event, so the activity baseline is updated (and logged) once per batch.
+    def _log_event(self, event_kind: str, action: str, xi2_raw: bool, count: int = 1):
+        logging.debug(f"EVENT kind={event_kind} action={action} blanked={self.blanked} xi2_raw={xi2_raw} count={count}")
+
+    def _wake_and_swallow(self, event_kind: str, xi2_raw: bool):
+        if self._debug:
+            self._log_event(event_kind, 'wake+swallow', xi2_raw)
+        self.wake_screen()
+
+    def _note_activity(self, count: int, last_kind: str, last_xi2_raw: bool):
+        if not self.ss_available:
+            self._last_activity_ns = time.monotonic_ns()
+            if self._debug:
+                self._log_event(last_kind, 'activity-update', last_xi2_raw, count)
+        elif self._debug:
+            self._log_event(last_kind, 'seen-no-update', last_xi2_raw, count)
+
+    def _classify_core(self, ev):
+        return CORE_EVENT_INFO.get(ev.type)
+
+    def _classify_with_xi2(self, ev):
+        info = CORE_EVENT_INFO.get(ev.type)
+        if info is not None:
+            return info
+        evtype_attr = getattr(ev, 'evtype', None)  # XI2 raw event type if GenericEvent
+        if evtype_attr is None:
+            return None
+        return self._raw_info.get(evtype_attr) or (f"RawUnknown({evtype_attr})", True, False)
+
     def process_events(self, swallow_if_blanked=True):
-        activity = False
+        count = 0
+        last = None
         while self.disp.pending_events():
-            ev = self.disp.next_event()
-            etype = ev.type
-            evtype_attr = getattr(ev, 'evtype', None)  # XI2 raw event type if GenericEvent
-
-            # Helper: debug log builder (only if DEBUG enabled)
-            def log_event(event_kind: str, action: str, extra: str = ""):
-                if logging.getLogger().isEnabledFor(logging.DEBUG):
-                    logging.debug(f"EVENT kind={event_kind} action={action} blanked={self.blanked} xi2_raw={self.xi2_raw_enabled and bool(evtype_attr)} {extra}")
-
-            # Core event name mapping
-            core_names = {
-                X.KeyPress: 'KeyPress',
-                X.KeyRelease: 'KeyRelease',
-                X.ButtonPress: 'ButtonPress',
-                X.ButtonRelease: 'ButtonRelease',
-                X.MotionNotify: 'MotionNotify',
-            }
-
-            # ---- Core events ----
-            if etype in core_names:
-                if self.blanked and swallow_if_blanked:
-                    log_event(core_names[etype], 'wake+swallow')
-                    self.wake_screen()
-                else:
-                    if not self.ss_available:
-                        self.last_activity = time.time()
-                        log_event(core_names[etype], 'activity-update')
-                    else:
-                        log_event(core_names[etype], 'seen-no-update')
-                activity = True
+            info = self._classify_event(self.disp.next_event())
+            if info is None:
                 continue
-
-            # ---- XI2 raw events ----
-            if self.xi2_raw_enabled and evtype_attr is not None:
-                # Build XI2 raw name map lazily
-                raw_map = {}
-                for name in ("RawMotion","RawKeyPress","RawKeyRelease","RawButtonPress","RawButtonRelease","RawTouchBegin","RawTouchUpdate","RawTouchEnd"):
-                    if hasattr(xinput, name):
-                        raw_map[getattr(xinput, name)] = name
-                raw_name = raw_map.get(evtype_attr, f"RawUnknown({evtype_attr})")
-                if self.blanked and swallow_if_blanked and raw_name in ("RawButtonPress","RawTouchBegin","RawKeyPress"):
-                    log_event(raw_name, 'wake+swallow')
-                    self.wake_screen()
-                else:
-                    if not self.ss_available:
-                        self.last_activity = time.time()
-                        log_event(raw_name, 'activity-update')
-                    else:
-                        log_event(raw_name, 'seen-no-update')
-                activity = True
-        return activity
+            kind, xi2_raw, can_wake = info
+            if self.blanked and swallow_if_blanked and can_wake:
+                self._wake_and_swallow(kind, xi2_raw)
+                return True  # Overlay is unmapped; anything still queued is ordinary activity
+            count += 1
+            last = info
+        if last is None:
+            return False
+        kind, xi2_raw, _ = last
+        self._note_activity(count, kind, xi2_raw)
+        return True
 
     # -------------- Main Loop --------------
     def run(self):
         logging.info(f"Started; timeout={self.timeout}s; swallowing first touch after blank")
-        x_fd = self.disp.fileno()
+        try:
+            self._loop()
+        finally:
+            self._destroy_overlay()
+            self._ep.close()
+            self._timer.close()
+
+    def _loop(self):
         while True:
-            if not self.blanked:
-                idle_sec = self.get_idle_seconds()
-                remaining = self.timeout - idle_sec
+            # Xlib may already hold parsed events in its userspace queue while the
+            # socket itself is not readable; handle those before blocking in epoll.
+            # Any X I/O below (idle query reply, flush) can read more events into that
+            # queue, so those paths loop back here instead of falling through to epoll.
+            if self.disp.pending_events():
+                self.process_events()
+                continue
+            if not self.blanked and not self._timer.armed:
+                # Input can only push the blank time later, so idle is re-queried only
+                # when the timer armed from the previous query has fired
+                remaining = self.timeout - self.get_idle_seconds()
                 if remaining <= 0:
-                    self.blank_screen()
-                    timeout = None  # Wait for input
+                    self.blank_screen()  # Timer stays disarmed while blanked; wait for input
                 else:
-                    timeout = remaining
-            else:
-                timeout = None
-            rlist, _, _ = select.select([x_fd], [], [], timeout)
-            if not rlist:
-                # Timeout path triggers blank already above; continue
+                    self._timer.arm(remaining)
                 continue
-            self.process_events()
+            for fd, _ in self._ep.poll(None, maxevents=2):
+                if fd == self._x_fd:
+                    self.process_events()
+                else:
+                    self._timer.consume()
 
 
 def main():